@@ -0,0 +1,8 @@
+"""
+FILE:       benchmark/__init__.py
+AUTHOR:     Ben Simcox
+PROJECT:    probable-guacamole
+PURPOSE:    Benchmarks and regression gates for md_to_html
+"""
+from benchmark.corpus import BLOCK_TYPES, DEFAULT_MIX, generate, write_corpus
+from benchmark.runner import compare, run
@@ -0,0 +1,79 @@
+"""
+FILE:       benchmark/__main__.py
+AUTHOR:     Ben Simcox
+PROJECT:    probable-guacamole
+PURPOSE:    Command line for the md_to_html benchmarks, python -m benchmark
+"""
+import argparse
+import json
+import sys
+from typing import Dict, List
+
+from benchmark.corpus import BLOCK_TYPES
+from benchmark.runner import compare, format_size, parse_size, run
+
+
+def _parse_mix(mix: str) -> Dict[str, float]:
+    """turn heading=1,list=2 into a mix of block type weights"""
+    weights = {}
+    for entry in mix.split(","):
+        kind, _, weight = entry.partition("=")
+        if kind not in BLOCK_TYPES:
+            raise argparse.ArgumentTypeError("unknown block type " + kind + ", expected one of " +
+                                             ", ".join(BLOCK_TYPES))
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def _report(results: dict) -> None:
+    """print a table of the measurements"""
+    for section in ["sizes", "block_types"]:
+        for name, result in results[section].items():
+            line = section + "/" + name + ": " + format(result["mb_per_s"], ".2f") + " MB/s"
+            if "peak_bytes" in result:
+                line += ", peak " + format_size(result["peak_bytes"] // 1024 * 1024)
+            print(line)
+
+
+def main(argv: List[str] = None) -> int:
+    """run the benchmarks, save them and gate them against a baseline"""
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="Benchmark md_to_html")
+    parser.add_argument("--sizes", default="1K,100K,1M,10M",
+                        help="comma separated document sizes, up to 100M (default: 1K,100K,1M,10M)")
+    parser.add_argument("--seed", type=int, default=0, help="corpus seed (default: 0)")
+    parser.add_argument("--mix", type=_parse_mix, default=None,
+                        help="block type weights such as paragraph=3,list=1 (default: a realistic mix)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, best is kept (default: 3)")
+    parser.add_argument("--block-size", type=parse_size, default="256K",
+                        help="size of each single block type corpus, 0 to skip them (default: 256K)")
+    parser.add_argument("--no-memory", action="store_true", help="skip the slower peak memory runs")
+    parser.add_argument("--legacy-inline", action="store_true", help="measure the original inline engine")
+    parser.add_argument("--mapped", action="store_true", help="read the corpus through a memory map")
+    parser.add_argument("--output", help="write results to this json file")
+    parser.add_argument("--baseline", help="json results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="fraction slower or larger than baseline that fails the run (default: 0.2)")
+    parser.add_argument("--update-baseline", action="store_true", help="write results over --baseline")
+    args = parser.parse_args(argv)
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    results = run(sizes, args.seed, args.mix, args.repeat, args.block_size, not args.no_memory,
+                  args.legacy_inline, args.mapped)
+    _report(results)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if not args.baseline:
+        return 0
+    if args.update_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        return 0
+    with open(args.baseline) as baseline_file:
+        regressions = compare(results, json.load(baseline_file), args.threshold)
+    for regression in regressions:
+        print("REGRESSION " + regression, file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""
+FILE:       benchmark/corpus.py
+AUTHOR:     Ben Simcox
+PROJECT:    probable-guacamole
+PURPOSE:    Seeded generator of realistic synthetic markdown
+"""
+import random
+from typing import Callable, Dict, Iterator, List
+
+_WORDS = ("the compiler reads each line of markdown and writes html for every block it finds "
+          "while lists headings quotes fences and comments each take their own path through "
+          "the parser so documents of every shape are worth measuring").split()
+_PUNCTUATION = [".", ",", ";", ":", "!", "?"]
+_POOL_SIZE = 500  # distinct blocks generated per type, sampled to build documents quickly
+
+
+def _words(rng: random.Random, count: int) -> List[str]:
+    """plain words, some followed by punctuation"""
+    words = [rng.choice(_WORDS) for _ in range(count)]
+    for index in range(0, count, rng.randint(5, 12)):
+        words[index] += rng.choice(_PUNCTUATION)
+    return words
+
+
+def _emphasise(rng: random.Random, word: str) -> str:
+    """wrap a word in one kind of inline markup"""
+    marker = rng.choice(["*", "**", "***", "`"])
+    return marker + word + marker
+
+
+def _heading(rng: random.Random) -> str:
+    """a heading of level one to five"""
+    return "#" * rng.randint(1, 5) + " " + " ".join(_words(rng, rng.randint(2, 8))) + "\n"
+
+
+def _paragraph(rng: random.Random) -> str:
+    """a line of plain prose"""
+    return " ".join(_words(rng, rng.randint(10, 80))) + "\n"
+
+
+def _emphasis(rng: random.Random) -> str:
+    """a line of prose where most words carry inline markup"""
+    words = _words(rng, rng.randint(10, 60))
+    return " ".join(_emphasise(rng, word) if rng.random() < 0.6 else word for word in words) + "\n"
+
+
+def _links(rng: random.Random) -> str:
+    """a line of prose scattered with links and images"""
+    words = _words(rng, rng.randint(10, 40))
+    for index in range(0, len(words), rng.randint(3, 6)):
+        target = "https://example.com/" + rng.choice(_WORDS) + "/" + str(rng.randint(1, 999))
+        if rng.random() < 0.3:
+            words[index] = "![" + words[index] + "](" + target + ".png)"
+        else:
+            words[index] = "[" + words[index] + "](" + target + ")"
+    return " ".join(words) + "\n"
+
+
+def _list(rng: random.Random) -> str:
+    """a run of ordered or unordered items, some nested with tabs"""
+    ordered = rng.random() < 0.4
+    items = []
+    for number in range(1, rng.randint(2, 12)):
+        bullet = str(number) + "." if ordered else rng.choice(["*", "-"])
+        indent = "\t" * (rng.random() < 0.3)
+        words = _words(rng, rng.randint(2, 12))
+        if rng.random() < 0.5:
+            words[0] = _emphasise(rng, words[0])
+        items.append(indent + bullet + " " + " ".join(words) + "\n")
+    return "".join(items)
+
+
+def _fence(rng: random.Random) -> str:
+    """a long fenced code block"""
+    lines = []
+    for _ in range(rng.randint(5, 200)):
+        lines.append("\t" * rng.randint(0, 3) + " ".join(_words(rng, rng.randint(1, 10))) + "\n")
+    return "```\n" + "".join(lines) + "```\n"
+
+
+def _comment(rng: random.Random) -> str:
+    """a multi-line html comment"""
+    lines = [" ".join(_words(rng, rng.randint(3, 12))) + "\n" for _ in range(rng.randint(1, 20))]
+    return "<!--\n" + "".join(lines) + "-->\n"
+
+
+def _blockquote(rng: random.Random) -> str:
+    """a one line block quote"""
+    return "> " + " ".join(_words(rng, rng.randint(5, 30))) + "\n"
+
+
+def _rule(rng: random.Random) -> str:
+    """a horizontal rule"""
+    return rng.choice(["---", "==="]) + "\n"
+
+
+BLOCK_TYPES = {
+    "heading": _heading,
+    "paragraph": _paragraph,
+    "emphasis": _emphasis,
+    "links": _links,
+    "list": _list,
+    "fence": _fence,
+    "comment": _comment,
+    "blockquote": _blockquote,
+    "hr": _rule,
+}  # type: Dict[str, Callable[[random.Random], str]]
+
+DEFAULT_MIX = {
+    "heading": 8,
+    "paragraph": 30,
+    "emphasis": 15,
+    "links": 10,
+    "list": 15,
+    "fence": 5,
+    "comment": 3,
+    "blockquote": 8,
+    "hr": 6,
+}
+
+
+def _iter_blocks(size: int, seed: int, mix: Dict[str, float]) -> Iterator[str]:
+    """yield blocks separated by blank lines until they add up to at least size characters"""
+    rng = random.Random(seed)
+    kinds = [kind for kind in mix if mix[kind] > 0]
+    weights = [mix[kind] for kind in kinds]
+    pools = {kind: [BLOCK_TYPES[kind](rng) + "\n" for _ in range(_POOL_SIZE)] for kind in kinds}
+    written = 0
+    while written < size:
+        for kind in rng.choices(kinds, weights, k=256):
+            block = rng.choice(pools[kind])
+            written += len(block)
+            yield block
+            if written >= size:
+                return
+
+
+def generate(size: int, seed: int = 0, mix: Dict[str, float] = None) -> str:
+    """return a document of roughly size characters, the same for the same seed and mix"""
+    return "".join(_iter_blocks(size, seed, mix or DEFAULT_MIX))
+
+
+def write_corpus(path: str, size: int, seed: int = 0, mix: Dict[str, float] = None) -> None:
+    """write generate(size, seed, mix) to path without holding it all in memory"""
+    with open(path, "w") as file:
+        for block in _iter_blocks(size, seed, mix or DEFAULT_MIX):
+            file.write(block)
@@ -0,0 +1,127 @@
+"""
+FILE:       benchmark/runner.py
+AUTHOR:     Ben Simcox
+PROJECT:    probable-guacamole
+PURPOSE:    Measure compile throughput and memory, and gate regressions against a baseline
+"""
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List
+
+import md_to_html
+from benchmark.corpus import BLOCK_TYPES, write_corpus
+
+_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+class _NullSink:
+    """write target that throws html away, so only compiling is measured"""
+
+    def write(self, text: str) -> None:
+        """discard text"""
+
+
+def parse_size(size: str) -> int:
+    """turn 1K, 100M and the like into a number of bytes"""
+    size = size.strip().upper()
+    if size and size[-1] in _UNITS:
+        return int(float(size[:-1]) * _UNITS[size[-1]])
+    return int(size)
+
+
+def format_size(size: int) -> str:
+    """inverse of parse_size for round sizes"""
+    for unit in ["G", "M", "K"]:
+        if size >= _UNITS[unit] and size % _UNITS[unit] == 0:
+            return str(size // _UNITS[unit]) + unit
+    return str(size)
+
+
+def _compile(path: str, legacy_inline: bool, mapped: bool) -> None:
+    """stream path through the compiler once, from text mode or through a memory map"""
+    if mapped:
+        for _ in md_to_html.compile_mapped(path, legacy_inline=legacy_inline):
+            pass
+        return
+    with open(path) as markdown_file:
+        md_to_html.compile_to(markdown_file, _NullSink(), legacy_inline)
+
+
+def _time_compile(path: str, repeat: int, legacy_inline: bool, mapped: bool) -> float:
+    """best wall clock seconds to stream path through the compiler"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _compile(path, legacy_inline, mapped)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _peak_memory(path: str, legacy_inline: bool, mapped: bool) -> int:
+    """peak bytes allocated by python while compiling path"""
+    tracemalloc.start()
+    try:
+        _compile(path, legacy_inline, mapped)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _measure(path: str, repeat: int, legacy_inline: bool, memory: bool, mapped: bool) -> dict:
+    """throughput, and optionally peak memory, of compiling one corpus file"""
+    size = os.path.getsize(path)
+    seconds = _time_compile(path, repeat, legacy_inline, mapped)
+    result = {"bytes": size, "seconds": seconds, "mb_per_s": size / max(seconds, 1e-9) / 1e6}
+    if memory:
+        result["peak_bytes"] = _peak_memory(path, legacy_inline, mapped)
+    return result
+
+
+def run(sizes: List[int], seed: int = 0, mix: Dict[str, float] = None, repeat: int = 3,
+        block_size: int = 256 * 1024, memory: bool = True, legacy_inline: bool = False,
+        mapped: bool = False) -> dict:
+    """benchmark whole documents of every size in sizes, then each block type on its own"""
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": seed,
+            "mix": mix,
+            "legacy_inline": legacy_inline,
+            "mapped": mapped,
+        },
+        "sizes": {},
+        "block_types": {},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "corpus.md")
+        for size in sizes:
+            write_corpus(path, size, seed, mix)
+            results["sizes"][format_size(size)] = _measure(path, repeat, legacy_inline, memory, mapped)
+        if block_size:
+            for kind in BLOCK_TYPES:
+                write_corpus(path, block_size, seed, {kind: 1})
+                results["block_types"][kind] = _measure(path, repeat, legacy_inline, False, mapped)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float = 0.2) -> List[str]:
+    """describe every measurement that got more than threshold slower or hungrier than baseline"""
+    regressions = []
+    for section in ["sizes", "block_types"]:
+        for name, current in results.get(section, {}).items():
+            previous = baseline.get(section, {}).get(name)
+            if previous is None:
+                continue
+            label = section + "/" + name
+            if current["mb_per_s"] < previous["mb_per_s"] * (1 - threshold):
+                regressions.append(label + ": " + format(current["mb_per_s"], ".2f") + " MB/s, baseline " +
+                                   format(previous["mb_per_s"], ".2f") + " MB/s")
+            if "peak_bytes" in current and "peak_bytes" in previous and \
+                    current["peak_bytes"] > previous["peak_bytes"] * (1 + threshold):
+                regressions.append(label + ": " + str(current["peak_bytes"]) + " peak bytes, baseline " +
+                                   str(previous["peak_bytes"]))
+    return regressions
@@ -0,0 +1,104 @@
+"""
+FILE:       document.py
+AUTHOR:     Ben Simcox
+PROJECT:    probable-guacamole
+PURPOSE:    Incrementally re-render a markdown document as it is edited
+"""
+import bisect
+import io
+from typing import Iterator, List, NamedTuple, Tuple
+
+from md_to_html import Compiler
+
+
+def _split_lines(text: str) -> List[str]:
+    """split text into lines the way reading it from a file in text mode would"""
+    return io.StringIO(text, newline=None).readlines()
+
+
+class BlockPatch(NamedTuple):
+    """Replace html blocks[index:index + removed] with html to bring a rendering up to date"""
+    index: int
+    removed: int
+    html: List[str]
+
+
+class _LinesCompiler(Compiler):
+    """Compiler reading a list of lines from a given line onwards"""
+
+    def __init__(self, lines: List[str], first_line: int, legacy_inline: bool):
+        """Initialize attributes without compiling anything yet"""
+        self._start(map(lines.__getitem__, range(first_line, len(lines))), legacy_inline)
+        self._line_number = first_line
+
+
+class Document:
+    """Markdown kept in memory with an index of the source lines behind every html block,
+    so an edit only re-parses the blocks it can affect"""
+
+    def __init__(self, text: str = "", legacy_inline: bool = False):
+        """Initialize attributes and compile the whole text once"""
+        self._legacy_inline = legacy_inline  # bool
+        self._lines = _split_lines(text)  # list of str
+        self._starts = []  # list of int, first line of every block
+        self._blocks = []  # list of str, html of every block, "" for blank lines
+        self._html = None  # str, joined blocks until the next edit
+        for first_line, _, block in self._parse_from(0):
+            self._starts.append(first_line)
+            self._blocks.append(block)
+
+    def get_text(self) -> str:
+        """return the markdown"""
+        return "".join(self._lines)
+
+    def get_html(self) -> str:
+        """return the html of the whole document"""
+        if self._html is None:
+            self._html = "".join(self._blocks)
+        return self._html
+
+    def get_blocks(self) -> List[Tuple[int, int, str]]:
+        """return (first line, line after the last, html) for every block"""
+        ends = self._starts[1:] + [len(self._lines)]
+        return list(zip(self._starts, ends, self._blocks))
+
+    def apply_edit(self, start_line: int, end_line: int, new_text: str) -> BlockPatch:
+        """Replace lines start_line up to but excluding end_line (counted from 0) with the
+        lines of new_text, re-parse only the blocks the edit can reach and return the patch"""
+        if not 0 <= start_line <= end_line <= len(self._lines):
+            raise IndexError("edit of lines " + str(start_line) + " to " + str(end_line) +
+                             " is outside a document of " + str(len(self._lines)) + " lines")
+        new_lines = _split_lines(new_text)
+        if new_lines and not new_lines[-1].endswith("\n") and end_line < len(self._lines):
+            new_lines[-1] += "\n"
+        if new_lines and start_line == len(self._lines) and start_line and not self._lines[-1].endswith("\n"):
+            self._lines[-1] += "\n"
+        self._lines[start_line:end_line] = new_lines
+        shift = len(new_lines) - (end_line - start_line)
+        # a list decides where it ends by peeking at the next line, so the block holding
+        # the line before the edit may change as well
+        first = max(bisect.bisect_right(self._starts, start_line - 1) - 1, 0)
+        edited_end = start_line + len(new_lines)
+        starts = []
+        blocks = []
+        last = len(self._starts)
+        for first_line, _, block in self._parse_from(self._starts[first] if self._starts else 0):
+            if first_line >= edited_end:
+                # past the edit, a block starting where an old one did re-parses identically
+                old = bisect.bisect_left(self._starts, first_line - shift, first + 1)
+                if old < len(self._starts) and self._starts[old] == first_line - shift:
+                    last = old
+                    break
+            starts.append(first_line)
+            blocks.append(block)
+        self._starts[first:last] = starts
+        self._blocks[first:last] = blocks
+        if shift:
+            following = first + len(starts)
+            self._starts[following:] = [line + shift for line in self._starts[following:]]
+        self._html = None
+        return BlockPatch(first, last - first, blocks)
+
+    def _parse_from(self, first_line: int) -> Iterator[Tuple[int, int, str]]:
+        """parse blocks starting at first_line until the end of the document"""
+        return _LinesCompiler(self._lines, first_line, self._legacy_inline)._iter_blocks()
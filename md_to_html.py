@@ -4,7 +4,53 @@ AUTHOR:     Ben Simcox
 PROJECT:    probable-guacamole
 PURPOSE:    Recursively compile markdown to html
 """
+import argparse
+import functools
+import hashlib
+import io
+import mmap
+import multiprocessing
+import operator
+import os
 import re
+import string
+import sys
+import time
+from typing import Callable, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from render_cache import RenderCache, content_key
+
+_LINE_TOKENS = re.compile("[\\t\\s]|[^\\t\\s]+")
+_LIST_NUMBER = re.compile("[0-9]+\\.")
+_INLINE_WORD = re.compile("(?<![^\\t\\s])[^\\t\\s]*[\\[*`][^\\t\\s]*")
+_IMAGE = re.compile(r"!\[(.+)\]\((.+)\)")
+_LINK = re.compile(r"\[(.+)\]\((.+)\)")
+_LINK_TEXT = re.compile(r"\[(.+)\]")
+_LINK_TARGET = re.compile(r"\((.+)\)")
+_LINE_FEED = re.compile(b"\n")
+_ANY_NEWLINE = re.compile(b"\r\n?|\n")
+_BATCH_LINES = re.compile("[^\n]*\n|[^\n]+")
+_FENCE = re.compile(b"```")
+_CARRIAGE_RETURN = re.compile(b"\r")
+_LONE_CARRIAGE_RETURN = re.compile(b"\r(?!\n)")
+_WORD_CHARACTERS = frozenset(string.ascii_letters + string.digits + "_*`")
+# block kind reported by profiling, and the Compiler method that parses it
+_BLOCK_HANDLERS = {
+    "comment": "_parse_comment_block",
+    "heading": "_parse_heading_block",
+    "fence": "_parse_fence_block",
+    "blockquote": "_parse_quote_block",
+    "hr": "_parse_rule_block",
+    "list": "_parse_list",
+    "paragraph": "_parse_paragraph_block",
+}
+# (marker, opening tag, closing tag), statement order is meaningful
+_INLINE_MARKERS = (
+    ("***", "<bold><em>", "</em></bold>"),
+    ("**", "<bold>", "</bold>"),
+    ("*", "<em>", "</em>"),
+    ("`", "<code>", "</code>"),
+)
 
 
 def _parse_bold_italic(token: str) -> str:
@@ -40,10 +86,118 @@ def _parse_italic(token: str) -> str:
     return token
 
 
-def _read_markdown(markdown_file_location: str) -> list:
-    """Reads a markdown file and returns a list of lines"""
+def _read_markdown(markdown_file_location: str) -> Iterator[str]:
+    """Lazily read a markdown file, yielding one line at a time"""
     with open(markdown_file_location) as file:
-        return file.readlines()
+        yield from file
+
+
+def _iter_lines(markdown_file: TextIO) -> Iterator[str]:
+    """Lazily read lines from any file-like object with a readline method"""
+    return iter(markdown_file.readline, "")
+
+
+def _decode_lines(source: bytes) -> Iterator[str]:
+    """Read lines out of raw markdown bytes exactly as open() in text mode would"""
+    return iter(io.TextIOWrapper(io.BytesIO(source)))
+
+
+class _BufferLines:
+    """Lines of an encoded buffer, bytes, a memoryview or an mmap, found by offset and decoded
+    a batch of whole lines at a time as they are read, with newlines translated as open() would"""
+
+    _BATCH = 16 * 1024  # bytes decoded at once, give or take a line
+
+    def __init__(self, buffer, encoding: str = "utf-8", mapping: mmap.mmap = None):
+        """Initialize attributes, the buffer itself is never copied.
+        encoding must keep ascii as ascii, mapping is closed along with the lines"""
+        self.buffer = buffer  # bytes-like
+        self._view = memoryview(buffer).cast("B")  # memoryview, slices of it share the buffer
+        self._encoding = encoding  # str
+        self._mapping = mapping  # mmap
+        self._position = 0  # int, offset just past the last decoded batch
+        self._batch = iter(())  # iterator over lines decoded but not yet read
+        self._crlf = _CARRIAGE_RETURN.search(self._view) is not None  # bool
+        # lines ending in a bare \r can't be told apart by searching for \n
+        self._lone_cr = self._crlf and _LONE_CARRIAGE_RETURN.search(self._view) is not None  # bool
+
+    def __iter__(self) -> Iterator[str]:
+        return self
+
+    def __next__(self) -> str:
+        """return the next line, decoding another batch when this one runs out"""
+        line = next(self._batch, None)
+        if line is None:
+            self._batch = iter(_BATCH_LINES.findall(self._decode_batch()))
+            return next(self._batch)
+        return line
+
+    def _decode_batch(self) -> str:
+        """Decode whole lines from the position on. A batch ends early on the first line that could
+        open a fence, so read_enclosed always starts right where the last batch ended"""
+        view = self._view
+        start = self._position
+        end = min(start + self._BATCH, len(view))
+        fence = _FENCE.search(view, start, end)
+        newline_after = end if fence is None else fence.end()
+        newline = (_ANY_NEWLINE if self._lone_cr else _LINE_FEED).search(view, newline_after)
+        self._position = len(view) if newline is None else newline.end()
+        text = str(view[start:self._position], self._encoding)
+        if self._crlf:
+            return text.replace("\r\n", "\n").replace("\r", "\n")
+        return text
+
+    def read_enclosed(self, final_token: str) -> Optional[Tuple[str, list, int]]:
+        """Read whole lines up to the one holding final_token as a token straight out of the buffer,
+        decoding them in one slice. Return (text before that line, its tokens or [] at the end of
+        the buffer, lines read), or None if the buffer's line endings need reading line by line"""
+        if self._lone_cr or operator.length_hint(self._batch):
+            return None
+        view = self._view
+        start = search = self._position
+        candidate = re.compile(b"(?m)^[^\n]*?" + re.escape(final_token.encode(self._encoding)))
+        while True:
+            match = candidate.search(view, search)
+            if match is None:
+                end = self._position = len(view)
+                closing = []
+                break
+            newline = _LINE_FEED.search(view, match.end())
+            search = len(view) if newline is None else newline.end()
+            closing = _tokenize(str(view[match.start():search], self._encoding).replace("\r\n", "\n"))
+            if final_token in closing:
+                end = match.start()
+                self._position = search
+                break
+        text = str(view[start:end], self._encoding)
+        if self._crlf:
+            text = text.replace("\r\n", "\n")
+        lines = text.count("\n")
+        if closing or (text and not text.endswith("\n")):
+            lines += 1
+        return text, closing, lines
+
+    def close(self) -> None:
+        """release the buffer, closing the mapping if these lines own one"""
+        self._view.release()
+        if self._mapping is not None:
+            self._mapping.close()
+
+
+def _map_markdown(markdown_file_location: str, encoding: str = "utf-8") -> _BufferLines:
+    """Memory map a markdown file and read lines straight out of the mapping"""
+    with open(markdown_file_location, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return _BufferLines(b"", encoding)  # an empty file can't be mapped
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return _BufferLines(mapping, encoding, mapping)
+
+
+@functools.lru_cache(maxsize=None)
+def _compiler_fingerprint() -> str:
+    """hash of this module's source, so cached renders expire whenever the compiler changes"""
+    with open(__file__, "rb") as compiler_source:
+        return hashlib.sha256(compiler_source.read()).hexdigest()
 
 
 def _parse_code_snippet(token: str) -> str:
@@ -59,15 +213,15 @@ def _parse_code_snippet(token: str) -> str:
 
 def _parse_link(token: str) -> str:
     """parse and return a link"""
-    text = re.search(r"\[(.+)\]", token).group(1)
-    url = re.search(r"\((.+)\)", token).group(1)
+    text = _LINK_TEXT.search(token).group(1)
+    url = _LINK_TARGET.search(token).group(1)
     return "<a href=\"" + url + "\">" + text + "</a>"
 
 
 def _parse_image(token: str) -> str:
     """parse and return an html image"""
-    text = re.search(r"\[(.+)\]", token).group(1)
-    path = re.search(r"\((.+)\)", token).group(1)
+    text = _LINK_TEXT.search(token).group(1)
+    path = _LINK_TARGET.search(token).group(1)
     return "<img src=\"" + path + "\" alt=\"" + text + "\"" + " />"
 
 
@@ -93,32 +247,110 @@ def _parse_inline_syntax(token: str) -> str:
     return token + punctuation
 
 
-def _parse_paragraph(line: list) -> str:
+def _lex_token(token: str) -> str:
+    """handle inline syntax for one token with a single character dispatch,
+    producing exactly what _parse_inline_syntax does"""
+    if "[" in token:
+        if _IMAGE.search(token):
+            return _parse_image(token)
+        if _LINK.search(token):
+            return _parse_link(token)
+    punctuation = ""
+    if token[-1] not in _WORD_CHARACTERS:
+        punctuation = token[-1]
+        token = token[:-1]
+    for marker, opening_tag, closing_tag in _INLINE_MARKERS:
+        opens = token.startswith(marker)
+        closes = token.endswith(marker)
+        if opens and closes and len(token) > 2 * len(marker):
+            return opening_tag + token[len(marker):-len(marker)] + closing_tag + punctuation
+        if opens:
+            return opening_tag + token[len(marker):] + punctuation
+        if closes:
+            return token[:-len(marker)] + closing_tag + punctuation
+    return token + punctuation
+
+
+def _lex_match(match) -> str:
+    """handle the inline syntax of a word found by _INLINE_WORD"""
+    return _lex_token(match.group())
+
+
+def _render_inline(line: list) -> str:
+    """render the inline syntax of a run of tokens in one scan, only
+    dispatching on the words that contain markup"""
+    return _INLINE_WORD.sub(_lex_match, "".join(line))
+
+
+def _render_inline_legacy(line: list) -> str:
+    """render the inline syntax of a run of tokens one regex cascade at a time"""
+    return "".join([_parse_inline_syntax(token) for token in line])
+
+
+def _parse_paragraph(line: list, render: Callable[[list], str] = _render_inline) -> str:
     """Parse markdown return html paragraph"""
-    paragraph_text = ""
     if len(line) == 1 and line[0] == '\n':
-        return paragraph_text
-    for word in line:
-        paragraph_text += _parse_inline_syntax(word)
-    return "<p>" + paragraph_text.strip() + "</p>\n"
+        return ""
+    return "<p>" + render(line).strip() + "</p>\n"
 
 
-def _parse_heading(line: list, level: int) -> str:
+def _parse_heading(line: list, level: int, render: Callable[[list], str] = _render_inline) -> str:
     """process an html heading"""
-    heading = "<h" + str(level) + ">"
-    line = line[1:]
-    while line:
-        token = line.pop(0)
-        heading += _parse_inline_syntax(token)
+    heading = "<h" + str(level) + ">" + render(line[1:])
     return heading.strip() + "</h" + str(level) + ">\n"
 
 
-def _parse_block_quote(line: list) -> str:
+def _parse_block_quote(line: list, render: Callable[[list], str] = _render_inline) -> str:
     """return a block quote"""
-    quote = "\n<blockquote>"
-    for word in line:
-        quote += _parse_inline_syntax(word)
-    return quote + "</blockquote>\n"
+    return "\n<blockquote>" + render(line) + "</blockquote>\n"
+
+
+def _build_preview(html: str) -> str:
+    """cut the first h1 and the start of the first paragraph out of compiled html"""
+    title = html[html.find("<h1>"):html.find("</h1>") + 5]
+    para_start = html.find("<p>")
+    para_end = html.find("</p>")
+    if para_end - para_start > 100:
+        preview_length = 100
+        while html[para_start + preview_length] != " ":
+            preview_length += 1
+        para_end = para_start + preview_length
+        para_preview = html[para_start:para_end] + "..."
+    else:
+        para_preview = html[para_start:para_end]
+    para_preview += "</p>"
+    preview = title + "\n" + para_preview
+    return preview
+
+
+def _stream_preview(blocks: Iterator[str]) -> str:
+    """build exactly what _build_preview would from the joined blocks, but stop
+    consuming them as soon as the title and the paragraph cut are decided"""
+    html = []
+    length = 0
+    found = {"<h1>": -1, "</h1>": -1, "<p>": -1, "</p>": -1}
+    text = None  # str, joined once the paragraph has to be cut on a word boundary
+    for block in blocks:
+        start = length
+        html.append(block)
+        length += len(block)
+        if text is not None:
+            text += block
+            if block.find(" ", max(0, found["<p>"] + 100 - start)) != -1:
+                return _build_preview(text)
+            continue
+        # every block ends in a newline, so no marker straddles two of them
+        for marker, position in found.items():
+            if position == -1 and marker in block:
+                found[marker] = start + block.find(marker)
+        if -1 in found.values():
+            continue
+        if found["</p>"] - found["<p>"] <= 100:
+            return _build_preview("".join(html))
+        text = "".join(html)
+        if text.find(" ", found["<p>"] + 100) != -1:
+            return _build_preview(text)
+    return _build_preview("".join(html))
 
 
 def _get_list_type(line: list) -> str:
@@ -128,7 +360,7 @@ def _get_list_type(line: list) -> str:
             continue
         if item in ["*", "-"]:
             return "<ul>"
-        if re.fullmatch("[0-9]+\\.", item):
+        if _LIST_NUMBER.fullmatch(item):
             return "<ol>"
         return ""
 
@@ -137,20 +369,52 @@ def _strip_list_item(line: list) -> list:
     """strip leading white space and list number or bullet"""
     stripped_list = []
     for item in line:
-        if item in ['\t', '\n', '*', '-'] or re.fullmatch("[0-9]+\\.", item):
+        if item in ['\t', '\n', '*', '-'] or _LIST_NUMBER.fullmatch(item):
             continue
         stripped_list.append(item)
     return stripped_list[1:]
 
 
+def _tokenize(line: str) -> list:
+    """split a line into words and single whitespace characters"""
+    return _LINE_TOKENS.findall(line)
+
+
 class Compiler:
     """Compiler class manages markdown to html compiling"""
 
-    def __init__(self, markdown_file_location: str):
-        """Initialize attributes"""
-        self.md_tokens = _read_markdown(markdown_file_location)  # list
-        self.html = self._compile()  # str
-        self.preview = self.get_preview()  # str
+    _stats = None  # dict, only once profiling is enabled
+    _profile_hooks = ()  # tuple of callables
+
+    def __init__(self, markdown_file_location: str, legacy_inline: bool = False, cache: RenderCache = None,
+                 mapped: bool = False):
+        """Initialize attributes, nothing is read until html or preview is first asked for.
+        legacy_inline selects the original per-token regex cascade, a cache hit on the
+        file's exact contents skips parsing entirely and mapped reads the file as utf-8
+        through a memory map instead of decoding all of it"""
+        self._markdown_file_location = markdown_file_location  # str
+        self._legacy_inline = legacy_inline  # bool
+        self._cache = cache  # RenderCache
+        self._mapped = mapped  # bool
+        self._html = None  # str
+        self._preview = None  # str
+
+    @property
+    def html(self) -> str:
+        """the whole document compiled, on first use"""
+        if self._html is None:
+            self._html = self._render(0, self._compile_lines)
+        return self._html
+
+    @property
+    def preview(self) -> str:
+        """the first h1 and the start of the first paragraph, without compiling past them"""
+        if self._preview is None:
+            if self._html is not None:
+                self._preview = _build_preview(self._html)
+            else:
+                self._preview = self._render(1, self._preview_lines)
+        return self._preview
 
     def get_html(self) -> str:
         """return the html"""
@@ -158,120 +422,452 @@ class Compiler:
 
     def get_preview(self) -> str:
         """return the preview"""
-        html = self.html
-        title = html[html.find("<h1>"):html.find("</h1>") + 5]
-        para_start = html.find("<p>")
-        para_end = html.find("</p>")
-        if para_end - para_start > 100:
-            preview_length = 100
-            while html[para_start + preview_length] != " ":
-                preview_length += 1
-            para_end = para_start + preview_length
-            para_preview = html[para_start:para_end] + "..."
+        return self.preview
+
+    def enable_profiling(self) -> None:
+        """Count calls, time and bytes through every block handler and the inline engine.
+        The instrumented handlers are swapped in here, so a compiler never profiled pays nothing"""
+        if self._stats is not None:
+            return
+        self._stats = {kind: {"calls": 0, "seconds": 0.0, "bytes_in": 0, "bytes_out": 0}
+                       for kind in list(_BLOCK_HANDLERS) + ["inline"]}
+        self._bytes_read = 0  # int
+        get_next_line = self._get_next_line
+
+        def counted_get_next_line() -> list:
+            """_get_next_line, counting the bytes of every line consumed"""
+            line = get_next_line()
+            self._bytes_read += len("".join(line).encode())
+            return line
+        self._get_next_line = counted_get_next_line
+        for kind, name in _BLOCK_HANDLERS.items():
+            setattr(self, name, self._profile_block(kind, getattr(self, name)))
+        if hasattr(self, "_render_inline"):
+            self._profile_inline()
+
+    def add_profile_hook(self, hook: Callable[[str, float, int, int], None]) -> None:
+        """Call hook(kind, seconds, bytes_in, bytes_out) after every profiled handler, enabling profiling"""
+        self._profile_hooks = self._profile_hooks + (hook,)
+        self.enable_profiling()
+
+    def get_stats(self) -> dict:
+        """return calls, seconds, bytes_in and bytes_out per block kind and for inline syntax,
+        inline time is also part of the time of the block it appears in"""
+        if self._stats is None:
+            return {}
+        return {kind: dict(counters) for kind, counters in self._stats.items()}
+
+    def _record(self, kind: str, seconds: float, bytes_in: int, bytes_out: int) -> None:
+        """add one profiled call to the stats and pass it to the hooks"""
+        counters = self._stats[kind]
+        counters["calls"] += 1
+        counters["seconds"] += seconds
+        counters["bytes_in"] += bytes_in
+        counters["bytes_out"] += bytes_out
+        for hook in self._profile_hooks:
+            hook(kind, seconds, bytes_in, bytes_out)
+
+    def _profile_block(self, kind: str, handler: Callable[..., str]) -> Callable[..., str]:
+        """wrap a block handler to record it under kind"""
+        def profiled(line: list, *args) -> str:
+            """the block handler, timed"""
+            # the first line was already read, any further ones are read by the handler
+            first_line = len("".join(line).encode())
+            bytes_read = self._bytes_read
+            start = time.perf_counter()
+            html = handler(line, *args)
+            seconds = time.perf_counter() - start
+            self._record(kind, seconds, first_line + self._bytes_read - bytes_read, len(html.encode()))
+            return html
+        return profiled
+
+    def _profile_inline(self) -> None:
+        """wrap the inline engine picked by _start to record it as inline"""
+        def profiled(render: Callable[..., str]) -> Callable[..., str]:
+            """the inline renderer, timed"""
+            def render_profiled(tokens) -> str:
+                bytes_in = len("".join(tokens).encode())
+                start = time.perf_counter()
+                html = render(tokens)
+                self._record("inline", time.perf_counter() - start, bytes_in, len(html.encode()))
+                return html
+            return render_profiled
+        self._render_inline = profiled(self._render_inline)
+        self._parse_token = profiled(self._parse_token)
+
+    def _render(self, part: int, render: Callable[[Iterator[str]], str]) -> str:
+        """render part 0 (html) or 1 (preview) from the file, going through the cache if there is one"""
+        if self._mapped:
+            lines = _map_markdown(self._markdown_file_location)
+            source = lines.buffer
+        elif self._cache is None:
+            return render(_read_markdown(self._markdown_file_location))
         else:
-            para_preview = html[para_start:para_end]
-        para_preview += "</p>"
-        preview = title + "\n" + para_preview
-        return preview
+            with open(self._markdown_file_location, "rb") as file:
+                source = file.read()
+            lines = _decode_lines(source)
+        if self._cache is None:
+            return render(lines)
+        try:
+            key = content_key(source, _compiler_fingerprint())
+            cached = self._cache.get(key) or (None, None)
+        except BaseException:
+            lines.close()
+            raise
+        if cached[part] is not None:
+            lines.close()
+            return cached[part]
+        result = render(lines)
+        self._cache.put(key, *((result, None) if part == 0 else (None, result)))
+        return result
+
+    def _compile_lines(self, lines: Iterator[str]) -> str:
+        """compile every line into html"""
+        self._start(lines, self._legacy_inline)
+        try:
+            return self._compile()
+        finally:
+            lines.close()
+
+    def _preview_lines(self, lines: Iterator[str]) -> str:
+        """compile only as many lines as the preview needs, then stop reading"""
+        self._start(lines, self._legacy_inline)
+        try:
+            return _stream_preview(self._iter_html())
+        finally:
+            lines.close()
+
+    def _start(self, lines: Iterator[str], legacy_inline: bool) -> None:
+        """Point the line cursor at lines and pick the inline engine"""
+        self.md_tokens = lines  # iterator
+        self._lookahead = None  # list
+        self._line_number = 0  # int, lines consumed so far
+        self._render_inline = _render_inline_legacy if legacy_inline else _render_inline
+        self._parse_token = _parse_inline_syntax if legacy_inline else _lex_token
+        if self._stats is not None:
+            self._profile_inline()
 
     def _compile(self):
         """Entry point where the parsing of markdown begins"""
-        html = ""
-        while self.md_tokens:
-            html += self._parse_line(self._get_next_line())
-        return html
+        return "".join(self._iter_html())
+
+    def _iter_html(self) -> Iterator[str]:
+        """Parse the remaining markdown, yielding html one finished block at a time"""
+        for _, _, block in self._iter_blocks():
+            if block:
+                yield block
+
+    def _iter_blocks(self) -> Iterator[Tuple[int, int, str]]:
+        """Parse the remaining markdown, yielding (first line, line after the last, html) per block,
+        blank lines included as blocks with no html so the blocks cover every line"""
+        while self._has_next_line():
+            first_line = self._line_number
+            block = self._parse_line(self._get_next_line())
+            yield first_line, self._line_number, block
 
     def _parse_line(self, line: list) -> str:
         """Process a line"""
         if len(line) == 0:
             return ""
         if line[0] == "<!--":
-            return "\n<!--" +\
-                   self._recursive_descent_parser(line[1:], True, "-->") +\
-                   "-->\n"
+            return self._parse_comment_block(line)
         if line[0] in ['#', '##', '###', '####', '#####']:
-            return _parse_heading(line, len(line[0]))
+            return self._parse_heading_block(line)
         if line[0] == "```":
-            return "\n<pre><code>\n" +\
-                   self._recursive_descent_parser(line[1:], False, "```") +\
-                   "\n</code></pre>\n"
+            return self._parse_fence_block(line)
         if line[0] == '>':
-            return _parse_block_quote(line[1:])
+            return self._parse_quote_block(line)
         if line[0] in ['---', '===']:
-            return "<hr />\n"
-        if line[0] in ['*', '-'] or re.fullmatch("[0-9]+\\.", line[0]):
+            return self._parse_rule_block(line)
+        if line[0] in ['*', '-'] or _LIST_NUMBER.fullmatch(line[0]):
             return self._parse_list(line, 0)
-        return _parse_paragraph(line)
+        return self._parse_paragraph_block(line)
+
+    def _parse_comment_block(self, line: list) -> str:
+        """process an html comment, however many lines it spans"""
+        return "\n<!--" + self._parse_enclosed(line[1:], True, "-->") + "-->\n"
+
+    def _parse_heading_block(self, line: list) -> str:
+        """process a heading"""
+        return _parse_heading(line, len(line[0]), self._render_inline)
+
+    def _parse_fence_block(self, line: list) -> str:
+        """process a fenced code block, however many lines it spans"""
+        read_enclosed = getattr(self.md_tokens, "read_enclosed", None)
+        if read_enclosed is not None and len(line) > 1 and "```" not in line[1:] and self._lookahead is None:
+            enclosed = read_enclosed("```")
+            if enclosed is not None:
+                # the body comes out of the buffer in one slice instead of line by line
+                body, closing, lines = enclosed
+                self._line_number += lines
+                if self._stats is not None:
+                    self._bytes_read += len(body.encode()) + len("".join(closing).encode())
+                if closing:
+                    closing = closing[:closing.index("```")]
+                code = "".join(line[1:]) + body + "".join(closing)
+                return "\n<pre><code>\n" + code.replace("\t", "    ") + "\n</code></pre>\n"
+        return "\n<pre><code>\n" + self._parse_enclosed(line[1:], False, "```") + "\n</code></pre>\n"
+
+    def _parse_quote_block(self, line: list) -> str:
+        """process a block quote"""
+        return _parse_block_quote(line[1:], self._render_inline)
+
+    def _parse_rule_block(self, line: list) -> str:
+        """process a horizontal rule"""
+        return "<hr />\n"
+
+    def _parse_paragraph_block(self, line: list) -> str:
+        """process a paragraph"""
+        return _parse_paragraph(line, self._render_inline)
 
     def _parse_comment(self, line: list) -> str:
         """process an html comment"""
-        comment = ""
-        if len(line) == 0:
-            line = self._get_next_line()
-        token = line.pop(0)
-        if token != "-->":
-            if token == "<!--":
-                comment += token
-            else:
-                comment += " " + token
-            comment += self._parse_comment(line)
-        elif token == "-->":
-            comment += " " + token + "\n"
-        return comment
+        comment = []
+        while True:
+            if len(line) == 0:
+                line = self._get_next_line()
+                if len(line) == 0:
+                    return "".join(comment)
+            for token in line:
+                if token == "-->":
+                    comment.append(" " + token + "\n")
+                    return "".join(comment)
+                comment.append(token if token == "<!--" else " " + token)
+            line = []
+
+    def _has_next_line(self) -> bool:
+        """check whether there is any markdown left to read"""
+        if self._lookahead is None:
+            self._lookahead = _tokenize(next(self.md_tokens, ""))
+        return len(self._lookahead) > 0
 
     def _get_next_line(self) -> list:
         """Get the next line of markdown, return it as a list"""
-        stripped_line = []
-        if self.md_tokens:
-            line = re.split("([\\t\\s])", self.md_tokens.pop(0))
-            for item in line:
-                if item == "":
-                    continue
-                stripped_line.append(item)
-        return stripped_line
-
-    def _recursive_descent_parser(self, line: list, parse_inline: bool, final_token: str) -> str:
-        """Recursively descend into and parse nested structures"""
-        result = ""
+        line = self._peek_next_line()
+        if line:
+            self._lookahead = None
+            self._line_number += 1
+        return line
+
+    def _peek_next_line(self) -> list:
+        """return the next line without popping it"""
+        self._has_next_line()
+        return self._lookahead
+
+    def _parse_enclosed(self, line: list, parse_inline: bool, final_token: str) -> str:
+        """Consume lines until final_token closes a fence or comment, however long it runs"""
+        result = []
         if len(line) == 0:
-            result += "\n"
+            result.append("\n")
             line = self._get_next_line()
         while line:
-            token = line.pop(0)
-            if token == final_token:
-                return result
-            if token == "\t":
-                result += "    "
-                continue
-            result += _parse_inline_syntax(token) if parse_inline else token
-        result += self._recursive_descent_parser(self._get_next_line(), parse_inline, final_token)
-        return result
+            closed = final_token in line
+            if closed:
+                line = line[:line.index(final_token)]
+            text = self._render_inline(line) if parse_inline else "".join(line)
+            result.append(text.replace("\t", "    "))
+            if closed:
+                break
+            line = self._get_next_line()
+        return "".join(result)
 
     def _parse_list(self, line: list, depth: int) -> str:
-        """Recursively handle ordered and unordered lists"""
+        """Handle ordered and unordered lists, one item per line"""
         opening_tag = _get_list_type(line)
-        closing_tag = re.sub("<", "</", opening_tag) + "\n"
-        list_text = opening_tag
+        closing_tag = opening_tag.replace("<", "</") + "\n"
+        list_text = [opening_tag]
         while True:
-            item = "<li>"
-            line = _strip_list_item(line)
-            for word in line:
-                item += _parse_inline_syntax(word)
+            # tokens are handled one at a time, stripping can leave words adjacent
+            item = "<li>" + "".join([self._parse_token(word) for word in _strip_list_item(line)])
             if _get_list_type(self._peek_next_line()) not in ["<ol>", "<ul>"]:
-                list_text += _parse_inline_syntax(item) + "</li>\n"
+                list_text.append(self._parse_token(item) + "</li>\n")
                 break
-            list_text += item + "</li>\n"
+            list_text.append(item + "</li>\n")
             line = self._get_next_line()
-        return list_text + closing_tag
-
-    def _peek_next_line(self) -> list:
-        """return the next line without popping it"""
-        stripped_line = []
-        if self.md_tokens:
-            line = re.split("([\\t\\s])", self.md_tokens[0])
-            for item in line:
-                if item == "":
-                    continue
-                stripped_line.append(item)
-        return stripped_line
-        return line
+        list_text.append(closing_tag)
+        return "".join(list_text)
+
+
+class _StreamCompiler(Compiler):
+    """Compiler fed from an open file-like object, parsed only as it is consumed"""
+
+    def __init__(self, markdown_file: TextIO, legacy_inline: bool = False):
+        """Initialize attributes without compiling anything yet"""
+        self._start(_iter_lines(markdown_file), legacy_inline)
+
+
+class _BufferCompiler(Compiler):
+    """Compiler fed from the lines of an encoded buffer, parsed only as it is consumed"""
+
+    def __init__(self, lines: _BufferLines, legacy_inline: bool = False):
+        """Initialize attributes without compiling anything yet"""
+        self._start(lines, legacy_inline)
+
+
+def compile_stream(markdown_file: TextIO, legacy_inline: bool = False) -> Iterator[str]:
+    """Lazily compile markdown read from a file-like object, one html block at a time"""
+    return _StreamCompiler(markdown_file, legacy_inline)._iter_html()
+
+
+def compile_to(markdown_file: TextIO, sink, legacy_inline: bool = False) -> None:
+    """Compile markdown from a file-like object straight into anything with a write method"""
+    for block in compile_stream(markdown_file, legacy_inline):
+        sink.write(block)
+
+
+def compile_buffer(buffer, encoding: str = "utf-8", legacy_inline: bool = False) -> Iterator[str]:
+    """Lazily compile markdown held in bytes, a memoryview or an mmap, one html block at a time.
+    Lines are decoded straight out of the buffer as they are parsed and fenced code in one slice"""
+    lines = _BufferLines(buffer, encoding)
+    try:
+        yield from _BufferCompiler(lines, legacy_inline)._iter_html()
+    finally:
+        lines.close()
+
+
+def compile_mapped(markdown_file_location: str, encoding: str = "utf-8", legacy_inline: bool = False) -> Iterator[str]:
+    """Lazily compile a markdown file through a memory map, one html block at a time"""
+    lines = _map_markdown(markdown_file_location, encoding)
+    try:
+        yield from _BufferCompiler(lines, legacy_inline)._iter_html()
+    finally:
+        lines.close()
+
+
+_build_cache = None  # RenderCache of the current build process, if any
+
+
+def _open_build_cache(location: str, max_bytes: int) -> None:
+    """Pool initializer giving each build process its own connection to the render cache"""
+    global _build_cache
+    _build_cache = RenderCache(location, max_bytes)
+
+
+def _write_atomically(destination: str, blocks: Iterable[str]) -> None:
+    """Write html next to destination and move it into place, so readers never see half a file"""
+    directory = os.path.dirname(destination)
+    os.makedirs(directory, exist_ok=True)
+    temporary = os.path.join(directory, "." + os.path.basename(destination) + "." + str(os.getpid()) + ".tmp")
+    try:
+        with open(temporary, "w") as html_file:
+            for block in blocks:
+                html_file.write(block)
+        os.replace(temporary, destination)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def _build_cached(source: str, destination: str) -> None:
+    """Compile one file of a build through the render cache, leaving current outputs untouched"""
+    with open(source, "rb") as markdown_file:
+        markdown = markdown_file.read()
+    key = content_key(markdown, _compiler_fingerprint())
+    if _build_cache.is_current(destination, key):
+        return
+    html, preview = _build_cache.get(key) or (None, None)
+    if html is None:
+        html = "".join(compile_stream(io.TextIOWrapper(io.BytesIO(markdown))))
+        try:
+            preview = _build_preview(html)
+        except IndexError:  # no space to cut the paragraph at, leave it to Compiler to report
+            preview = None
+        _build_cache.put(key, html, preview)
+    _write_atomically(destination, [html])
+    _build_cache.record_output(destination, key)
+
+
+def _build_file(paths: Tuple[str, str]) -> Tuple[str, str]:
+    """Compile one file of a build, return (source, error) where error is empty on success"""
+    source, destination = paths
+    try:
+        if _build_cache is not None:
+            _build_cached(source, destination)
+        else:
+            with open(source) as markdown_file:
+                _write_atomically(destination, compile_stream(markdown_file))
+        return source, ""
+    except Exception as error:  # report the file and keep the batch going
+        return source, type(error).__name__ + ": " + str(error)
+
+
+def _find_markdown(source_root: str, destination_root: str) -> List[Tuple[str, str]]:
+    """Walk source_root, pairing every .md file with its mirrored .html destination"""
+    tasks = []
+    for directory, subdirectories, files in os.walk(source_root):
+        subdirectories.sort()
+        relative = os.path.relpath(directory, source_root)
+        for name in sorted(files):
+            stem, extension = os.path.splitext(name)
+            if extension.lower() != ".md":
+                continue
+            tasks.append((os.path.join(directory, name),
+                          os.path.normpath(os.path.join(destination_root, relative, stem + ".html"))))
+    return tasks
+
+
+def build(source_root: str, destination_root: str, workers: int = 0, chunksize: int = 0,
+          cache_location: str = None, cache_bytes: int = 256 * 1024 * 1024) -> List[Tuple[str, str]]:
+    """Compile every markdown file under source_root into a mirrored tree under
+    destination_root across a process pool, return (source, error) for each failure.
+    With a cache_location, files whose render is cached and output is current are skipped"""
+    global _build_cache
+    tasks = _find_markdown(source_root, destination_root)
+    workers = workers or os.cpu_count() or 1
+    initargs = (cache_location, cache_bytes)
+    if workers == 1 or len(tasks) < 2:
+        if cache_location is not None:
+            _open_build_cache(*initargs)
+        try:
+            return [result for result in map(_build_file, tasks) if result[1]]
+        finally:
+            if _build_cache is not None:
+                _build_cache.close()
+                _build_cache = None
+    chunksize = chunksize or max(1, min(64, len(tasks) // (workers * 4)))
+    initializer = _open_build_cache if cache_location is not None else None
+    with multiprocessing.Pool(min(workers, len(tasks)), initializer, initargs) as pool:
+        results = pool.imap_unordered(_build_file, tasks, chunksize)
+        return [result for result in results if result[1]]
+
+
+def main(argv: List[str] = None) -> int:
+    """Command line entry point, python -m md_to_html build SRC DST"""
+    parser = argparse.ArgumentParser(prog="python -m md_to_html", description="Compile markdown to html")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="compile every .md file in a directory tree")
+    build_parser.add_argument("source", metavar="SRC", help="directory to read markdown from")
+    build_parser.add_argument("destination", metavar="DST", help="directory to mirror html into")
+    build_parser.add_argument("-j", "--workers", type=int, default=0,
+                              help="number of worker processes (default: one per cpu)")
+    build_parser.add_argument("--chunksize", type=int, default=0,
+                              help="files handed to a worker at a time (default: sized to the batch)")
+    build_parser.add_argument("--cache", metavar="PATH",
+                              help="render cache file, unchanged files are not recompiled or rewritten")
+    build_parser.add_argument("--cache-size", type=int, default=256, metavar="MB",
+                              help="evict least recently used renders beyond this size (default: 256)")
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.source):
+        parser.error(args.source + " is not a directory")
+    before = {}
+    if args.cache:
+        cache = RenderCache(args.cache)
+        before = cache.stats()
+        cache.close()
+    failures = build(args.source, args.destination, args.workers, args.chunksize,
+                     args.cache, args.cache_size * 1024 * 1024)
+    for source, error in failures:
+        print(source + ": " + error, file=sys.stderr)
+    if args.cache:
+        cache = RenderCache(args.cache)
+        after = cache.stats()
+        cache.close()
+        print("cache: " + str(after["hits"] - before["hits"]) + " hits, " +
+              str(after["misses"] - before["misses"]) + " misses, " +
+              str(after["entries"]) + " entries, " + str(after["bytes"]) + " bytes")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
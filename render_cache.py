@@ -0,0 +1,156 @@
+"""
+FILE:       render_cache.py
+AUTHOR:     Ben Simcox
+PROJECT:    probable-guacamole
+PURPOSE:    Persistent content-addressed cache of compiled html
+"""
+import hashlib
+import os
+import sqlite3
+import time
+from typing import Optional, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS renders (
+    key TEXT PRIMARY KEY,
+    html TEXT,
+    preview TEXT,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS renders_used ON renders (used);
+CREATE TABLE IF NOT EXISTS outputs (
+    destination TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    total INTEGER NOT NULL,
+    hits INTEGER NOT NULL,
+    misses INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO usage VALUES (0, 0, 0, 0);
+CREATE TRIGGER IF NOT EXISTS renders_insert AFTER INSERT ON renders BEGIN
+    UPDATE usage SET total = total + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS renders_update AFTER UPDATE OF size ON renders BEGIN
+    UPDATE usage SET total = total + new.size - old.size;
+END;
+CREATE TRIGGER IF NOT EXISTS renders_delete AFTER DELETE ON renders BEGIN
+    UPDATE usage SET total = total - old.size;
+END;
+"""
+
+
+def content_key(source: bytes, fingerprint: str) -> str:
+    """hash markdown source together with the fingerprint of the compiler that renders it"""
+    digest = hashlib.sha256(fingerprint.encode())
+    digest.update(b"\0")
+    digest.update(source)
+    return digest.hexdigest()
+
+
+def _size(html: Optional[str], preview: Optional[str]) -> int:
+    """bytes a cached render occupies"""
+    return len((html or "").encode()) + len((preview or "").encode())
+
+
+class RenderCache:
+    """Size bounded LRU of (html, preview) renders on disk, shared by processes through sqlite"""
+
+    def __init__(self, location: str, max_bytes: int = 256 * 1024 * 1024):
+        """Initialize attributes, creating the cache file if needed"""
+        self.location = location
+        self.max_bytes = max_bytes
+        self.hits = 0  # int, this process only
+        self.misses = 0  # int, this process only
+        self._connection = sqlite3.connect(location, timeout=60, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript("BEGIN IMMEDIATE;" + _SCHEMA + "COMMIT;")
+
+    def close(self) -> None:
+        """close the connection to the cache file"""
+        self._connection.close()
+
+    def get(self, key: str) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        """return the cached (html, preview) for key, either may be None if never stored"""
+        row = self._connection.execute("SELECT html, preview FROM renders WHERE key = ?", (key,)).fetchone()
+        self._count(row is not None)
+        if row is not None:
+            self._connection.execute("UPDATE renders SET used = ? WHERE key = ?", (time.time(), key))
+        return row
+
+    def put(self, key: str, html: Optional[str] = None, preview: Optional[str] = None) -> None:
+        """store a render, keeping whatever part of an existing entry is not given"""
+        connection = self._connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT html, preview FROM renders WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                connection.execute("INSERT INTO renders VALUES (?, ?, ?, ?, ?)",
+                                   (key, html, preview, _size(html, preview), time.time()))
+            else:
+                html = row[0] if html is None else html
+                preview = row[1] if preview is None else preview
+                connection.execute("UPDATE renders SET html = ?, preview = ?, size = ?, used = ? WHERE key = ?",
+                                   (html, preview, _size(html, preview), time.time(), key))
+            self._evict()
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def is_current(self, destination: str, key: str) -> bool:
+        """check whether destination still holds exactly what was last written to it from key"""
+        row = self._connection.execute("SELECT key, size, mtime FROM outputs WHERE destination = ?",
+                                       (destination,)).fetchone()
+        if row is None or row[0] != key:
+            return False
+        try:
+            stat = os.stat(destination)
+        except OSError:
+            return False
+        if (stat.st_size, stat.st_mtime_ns) != (row[1], row[2]):
+            return False
+        self._count(True)
+        self._connection.execute("UPDATE renders SET used = ? WHERE key = ?", (time.time(), key))
+        return True
+
+    def record_output(self, destination: str, key: str) -> None:
+        """remember that destination was just written from the render stored under key"""
+        stat = os.stat(destination)
+        self._connection.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?)",
+                                 (destination, key, stat.st_size, stat.st_mtime_ns))
+
+    def stats(self) -> dict:
+        """return entries, bytes, hits and misses across every process sharing the cache"""
+        entries = self._connection.execute("SELECT COUNT(*) FROM renders").fetchone()[0]
+        total, hits, misses = self._connection.execute("SELECT total, hits, misses FROM usage").fetchone()
+        return {"entries": entries, "bytes": total, "hits": hits, "misses": misses}
+
+    def _count(self, hit: bool) -> None:
+        """count a lookup in this process and in the shared totals"""
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        column = "hits" if hit else "misses"
+        self._connection.execute("UPDATE usage SET " + column + " = " + column + " + 1")
+
+    def _evict(self) -> None:
+        """drop least recently used renders until the cache fits in max_bytes again"""
+        total = self._connection.execute("SELECT total FROM usage").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # evict down to 90% so a full cache isn't trimmed on every single put
+        excess = total - self.max_bytes * 9 // 10
+        victims = []
+        for key, size in self._connection.execute("SELECT key, size FROM renders ORDER BY used"):
+            victims.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._connection.executemany("DELETE FROM renders WHERE key = ?", victims)
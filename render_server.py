@@ -0,0 +1,195 @@
+"""
+FILE:       render_server.py
+AUTHOR:     Ben Simcox
+PROJECT:    probable-guacamole
+PURPOSE:    Asyncio http service rendering markdown files under a root directory
+"""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import sys
+import urllib.parse
+from typing import List, Tuple
+
+from md_to_html import Compiler
+
+_PARTS = ("html", "preview")
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            500: "Internal Server Error"}
+
+
+def _render(path: str, part: str) -> bytes:
+    """compile one file in a worker process, returning the html or preview encoded"""
+    compiler = Compiler(path)
+    return (compiler.get_html() if part == "html" else compiler.get_preview()).encode()
+
+
+class RenderServer:
+    """Serves GET /html/<path> and GET /preview/<path> for markdown files under root.
+    Compiles run in a bounded process pool, results are kept in a memory bounded LRU
+    invalidated by mtime and size, and concurrent requests for the same render share one compile"""
+
+    def __init__(self, root: str, workers: int = 0, max_bytes: int = 64 * 1024 * 1024):
+        """Initialize attributes"""
+        self.root = os.path.realpath(root)
+        self.max_bytes = max_bytes
+        self.compiles = 0  # int, renders handed to the pool
+        self.hits = 0  # int, renders served from memory
+        self.coalesced = 0  # int, renders that waited on a compile already running
+        # spawned rather than forked, a forked worker would inherit open client sockets
+        # and keep those connections from ever closing
+        self._pool = concurrent.futures.ProcessPoolExecutor(workers or os.cpu_count() or 1,
+                                                            multiprocessing.get_context("spawn"))
+        self._cache = collections.OrderedDict()  # (path, part) -> (signature, bytes)
+        self._cached_bytes = 0  # int
+        self._pending = {}  # (path, part) -> (signature, future)
+
+    def close(self) -> None:
+        """shut the process pool down"""
+        self._pool.shutdown()
+
+    async def render(self, relative_path: str, part: str) -> bytes:
+        """return the encoded html or preview of a file under root, compiling it only if it changed"""
+        path = self._resolve(relative_path)
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        key = (path, part)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == signature:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+        pending = self._pending.get(key)
+        if pending is not None and pending[0] == signature:
+            self.coalesced += 1
+            return await asyncio.shield(pending[1])
+        self.compiles += 1
+        future = asyncio.get_running_loop().run_in_executor(self._pool, _render, path, part)
+        self._pending[key] = (signature, future)
+        future.add_done_callback(lambda done: self._finish(key, signature, done))
+        # shielded so a client hanging up doesn't cancel the compile others are waiting on
+        return await asyncio.shield(future)
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000) -> None:
+        """accept connections until cancelled"""
+        # a deep accept backlog, with the default of 100 a burst of readers waits out syn retries
+        server = await asyncio.start_server(self._handle, host, port, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    def _resolve(self, relative_path: str) -> str:
+        """map a request path onto a file under root, refusing anything that escapes it"""
+        path = os.path.realpath(os.path.join(self.root, relative_path.lstrip("/")))
+        if os.path.commonpath([self.root, path]) != self.root or not os.path.isfile(path):
+            raise FileNotFoundError(relative_path)
+        return path
+
+    def _finish(self, key: Tuple[str, str], signature: Tuple[int, int], future: asyncio.Future) -> None:
+        """forget a finished compile and keep its result if it succeeded"""
+        if self._pending.get(key, (None, None))[1] is future:
+            del self._pending[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+        body = future.result()
+        if len(body) > self.max_bytes:
+            return
+        previous = self._cache.pop(key, None)
+        if previous is not None:
+            self._cached_bytes -= len(previous[1])
+        self._cache[key] = (signature, body)
+        self._cached_bytes += len(body)
+        while self._cached_bytes > self.max_bytes:
+            _, (_, evicted) = self._cache.popitem(last=False)
+            self._cached_bytes -= len(evicted)
+
+    async def _respond(self, method: str, target: str) -> Tuple[int, bytes]:
+        """route one request to a status and body"""
+        if method not in ["GET", "HEAD"]:
+            return 405, b"only GET and HEAD are supported\n"
+        path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+        part, _, relative_path = path.lstrip("/").partition("/")
+        if part not in _PARTS or not relative_path:
+            return 404, b"expected /html/<path> or /preview/<path>\n"
+        try:
+            return 200, await self.render(relative_path, part)
+        except FileNotFoundError:
+            return 404, b"no such file\n"
+        except Exception as error:  # a broken file shouldn't take the server down
+            return 500, (type(error).__name__ + ": " + str(error) + "\n").encode()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """serve http/1.1 requests on one connection, keeping it alive between them"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in [b"\r\n", b"\n", b""]:
+                        break
+                    name, _, value = header.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if headers.get("content-length", "0").isdigit():
+                    await reader.readexactly(int(headers.get("content-length", "0")))
+                request = request_line.decode("latin-1").split()
+                if len(request) != 3:
+                    await self._write(writer, "HEAD", 400, b"malformed request line\n", False)
+                    break
+                method, target, version = request
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" or (version == "HTTP/1.1" and connection != "close")
+                status, body = await self._respond(method, target)
+                await self._write(writer, method, status, body, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # client went away or sent something unreadable, drop the connection
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _write(writer: asyncio.StreamWriter, method: str, status: int, body: bytes,
+                     keep_alive: bool) -> None:
+        """send one response"""
+        content_type = "text/html" if status == 200 else "text/plain"
+        head = ("HTTP/1.1 " + str(status) + " " + _REASONS[status] + "\r\n" +
+                "Content-Type: " + content_type + "; charset=utf-8\r\n" +
+                "Content-Length: " + str(len(body)) + "\r\n" +
+                "Connection: " + ("keep-alive" if keep_alive else "close") + "\r\n\r\n")
+        writer.write(head.encode("latin-1"))
+        if method != "HEAD":
+            writer.write(body)
+        await writer.drain()
+
+
+def main(argv: List[str] = None) -> int:
+    """Command line entry point, python -m render_server ROOT"""
+    parser = argparse.ArgumentParser(prog="python -m render_server",
+                                     description="Serve compiled markdown from a directory")
+    parser.add_argument("root", metavar="ROOT", help="directory of markdown files to serve")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on (default: 8000)")
+    parser.add_argument("-j", "--workers", type=int, default=0,
+                        help="compile processes (default: one per cpu)")
+    parser.add_argument("--cache-size", type=int, default=64, metavar="MB",
+                        help="memory for compiled results (default: 64)")
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.root):
+        parser.error(args.root + " is not a directory")
+    server = RenderServer(args.root, args.workers, args.cache_size * 1024 * 1024)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
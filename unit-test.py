@@ -12,6 +12,8 @@ def main():
     compiler = m2h.Compiler("test.md")
     print("\nPreview:\n" + compiler.get_preview())
     print("\nFull:\n" + compiler.get_html())
+    legacy = m2h.Compiler("test.md", legacy_inline=True)
+    print("\nLegacy inline matches: " + str(legacy.get_html() == compiler.get_html()))
 
 
 if __name__ == '__main__':